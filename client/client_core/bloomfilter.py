@@ -1,53 +1,194 @@
-from bitarray import bitarray   # Bloom filters use bit arrays
-import mmh3                     # For optimized, non-cryptographic hash functions
+from __future__ import annotations      # To return BloomFilter from its own class methods
+
+import numpy as np              # Bloom filter blocks are stored as arrays of 64-bit words
 import math                     # For computing values
+from numba import njit, prange  # For compiling the insert and check loops
+from pathlib import Path
+import struct                   # For the header of the saved bloom filter
+import os
 
 import constants as c
 
 
+BLOCK_WORDS = 8                     # 8 words of 64 bits, one 64-byte cache line per block
+BLOCK_BITS = BLOCK_WORDS * 64       # 512 bits per block
+MAX_HASH_COUNT = 8
+MASK32 = 0xFFFFFFFF
+
+# Keys are SHA-256 hash prefixes, which are already uniformly random, so they are not hashed again
+# Their first 4 bytes are read as a uint32 and spread over 64 bits with a multiply-shift remixer
+GOLDEN_RATIO64 = np.uint64(0x9E3779B97F4A7C15)
+
+# Odd constants used to remix the low half of the key's hash into a different bit position per probe
+SALTS = np.array([
+    0x47B6137B, 0x44974D91, 0x8824AD5B, 0xA2B7289D,
+    0x705495C7, 0x2DF1424B, 0x9EFC4947, 0x5C6BFB31
+], dtype=np.uint64)
+
+# Saved bloom filters start with a 32-byte header: magic, version, num_blocks, hash_count, seed
+# The raw words of the bit array follow it
+FILE_MAGIC = b"GCBF"
+FILE_VERSION = 2
+FILE_HEADER = struct.Struct("<4sIQIQ4x")
+
+# Numba turns mixed signed/unsigned arithmetic into floats, so the compiled code only uses uint64 constants
+U32 = np.uint64(32)
+U_MASK32 = np.uint64(MASK32)
+
+
+def blocked_fp_rate(keys_per_block: float, hash_count: int) -> float:
+    # Keys are not spread evenly over the blocks, the load of each block follows a Poisson distribution,
+    # so the false positive rate is the classic bloom filter rate averaged over every possible block load
+    fp_rate = 0.0
+    max_load = int(keys_per_block + 10*math.sqrt(keys_per_block) + 10)
+
+    for load in range(max_load + 1):
+        probability = math.exp(load*math.log(keys_per_block) - keys_per_block - math.lgamma(load+1))
+        fp_rate += probability * (1 - (1 - 1/BLOCK_BITS)**(hash_count*load))**hash_count
+
+    return fp_rate
+
+# =================================================================================================
+# COMPILED FUNCTIONS ==============================================================================
+
+@njit(cache=True, parallel=True)
+def add_keys(bit_array: np.ndarray, keys: np.ndarray, seed: np.uint64, salts: np.ndarray) -> None:
+    num_blocks = np.uint64(bit_array.shape[0])
+    blocks = np.empty(len(keys), dtype=np.uint64)
+    masks = np.zeros((len(keys), BLOCK_WORDS), dtype=np.uint64)
+
+    # Remix the keys and build their masks in parallel, same math as add_key
+    for k in prange(len(keys)):
+        digest = (np.uint64(keys[k]) ^ seed) * GOLDEN_RATIO64
+        blocks[k] = ((digest >> U32) * num_blocks) >> U32
+        for salt in salts:
+            bit = (((digest & U_MASK32) * salt) & U_MASK32) >> np.uint64(23)
+            masks[k, bit >> np.uint64(6)] |= np.uint64(1) << (bit & np.uint64(63))
+
+    # Keys may share a block, so the masks are merged into the filter by a single thread
+    for k in range(len(keys)):
+        for word in range(BLOCK_WORDS):
+            bit_array[blocks[k], word] |= masks[k, word]
+
+
+@njit(cache=True)
+def add_key(bit_array: np.ndarray, key: np.uint64, salts: np.ndarray) -> None:
+    # The key arrives already xored with the seed
+    digest = key * GOLDEN_RATIO64
+    block = ((digest >> U32) * np.uint64(bit_array.shape[0])) >> U32
+    for salt in salts:
+        bit = (((digest & U_MASK32) * salt) & U_MASK32) >> np.uint64(23)
+        bit_array[block, bit >> np.uint64(6)] |= np.uint64(1) << (bit & np.uint64(63))
+
+
+@njit(cache=True)
+def check_key(bit_array: np.ndarray, key: np.uint64, salts: np.ndarray) -> bool:
+    digest = key * GOLDEN_RATIO64
+    block = ((digest >> U32) * np.uint64(bit_array.shape[0])) >> U32
+    # Stop at the first 0 bit, most keys that are not in the set fail on their first probe
+    for salt in salts:
+        bit = (((digest & U_MASK32) * salt) & U_MASK32) >> np.uint64(23)
+        if bit_array[block, bit >> np.uint64(6)] & (np.uint64(1) << (bit & np.uint64(63))) == 0:
+            return False
+    return True
+
+# =================================================================================================
+
+
 class BloomFilter:
     def __init__(self, entry_count: int):
+        entry_count += 24
+
         # Compute the size of the bit array based on the expected item count,
         # and a given false positive probability
-        bitarray_size = -((entry_count+24) * math.log(c.BF_FP_PROBABILITY)) / (math.log(2)**2)
+        bitarray_size = -(entry_count * math.log(c.BF_FP_PROBABILITY)) / (math.log(2)**2)
+        self.num_blocks = max(1, math.ceil(bitarray_size / BLOCK_BITS))
 
-        # Compute the amount of hashes that must be done for each entry
-        self.hash_count = max(1, int((bitarray_size/entry_count) * math.log(2)))
+        # Every probe of a key lands in the same block, which makes blocked filters less accurate than classic ones
+        # Pick the best amount of hashes for the blocked layout, and grow the filter until it meets the target
+        while True:
+            keys_per_block = entry_count / self.num_blocks
+            self.hash_count = min(range(1, MAX_HASH_COUNT+1), key=lambda k: blocked_fp_rate(keys_per_block, k))
+            if blocked_fp_rate(keys_per_block, self.hash_count) <= c.BF_FP_PROBABILITY:
+                break
+            self.num_blocks += max(1, self.num_blocks // 32)
 
-        # Initialize the bit array
-        self.bit_array = bitarray(int(bitarray_size))
-        self.bit_array.setall(0)
+        # Initialize the bit array, one row of 8 words for each 64-byte block
+        self.bit_array = np.zeros((self.num_blocks, BLOCK_WORDS), dtype=np.uint64)
+        self.salts = SALTS[:self.hash_count]
+        # A fixed seed keeps the bit positions reproducible across rebuilds
+        self.seed = c.BF_HASH_SEED
 
     # =================================================================================================
     # CORE FUNCTIONS ==================================================================================
-    
+
     def add(self, key: bytes) -> None:
-        # Hash the item multiple times into the bit array,
-        # use i as the seed to give a different result each time
-        for i in range(self.hash_count):
-            digest = self.get_digest(key, i)
-            self.bit_array[digest] = True
+        # Set every bit of the key in a single block
+        add_key(self.bit_array, self.get_key(key), self.salts)
 
 
     def check(self, key: bytes) -> bool:
-        # Hash the item multiple times and check the bit values
+        # Check the bit values within the key's block
         # Hitting a 0 bit means the item is not in the set
-        for i in range(self.hash_count):
-            if not self.bit_array[self.get_digest(key, i)]:
-                return False
-        
         # If the check returns true, it may be a false positive
-        return True
-    
+        return check_key(self.bit_array, self.get_key(key), self.salts)
+
+
+    def add_many(self, buf: bytes | memoryview, stride: int) -> None:
+        # Add every fixed-size record of the buffer in one compiled pass, only the first 4 bytes of a record are used
+        records = np.frombuffer(buf, dtype=np.uint8).reshape(-1, stride)[:, :4]
+        keys = np.ascontiguousarray(records).view("<u4").ravel()
+        add_keys(self.bit_array, keys, np.uint64(self.seed), self.salts)
+
+    # =================================================================================================
+    # FILE FUNCTIONS ==================================================================================
+
+    def to_file(self, path: Path) -> None:
+        # Write into a temporary file first and swap it in, a failed save never leaves half a filter behind
+        temp_path = Path(path).with_suffix(".tmp")
+        with open(temp_path, "wb") as f:
+            f.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, self.num_blocks, self.hash_count, self.seed))
+            self.bit_array.tofile(f)
+        os.replace(temp_path, path)
+
+
+    @classmethod
+    def from_file(cls, path: Path) -> BloomFilter:
+        with open(path, "rb") as f:
+            header = f.read(FILE_HEADER.size)
+            if len(header) != FILE_HEADER.size:
+                raise ValueError(f"{path} is too short to be a bloom filter file")
+
+            magic, version, num_blocks, hash_count, seed = FILE_HEADER.unpack(header)
+            if magic != FILE_MAGIC or version != FILE_VERSION:
+                raise ValueError(f"{path} is not a version {FILE_VERSION} bloom filter file")
+
+            # Read the bit array in one call, the file is closed afterwards so saving can replace it on any OS
+            bit_array = np.fromfile(f, dtype=np.uint64, count=num_blocks*BLOCK_WORDS)
+        if len(bit_array) != num_blocks*BLOCK_WORDS:
+            raise ValueError(f"{path} is missing part of its bit array")
+
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.num_blocks = num_blocks
+        bloom_filter.hash_count = hash_count
+        bloom_filter.salts = SALTS[:hash_count]
+        bloom_filter.seed = seed
+        bloom_filter.bit_array = bit_array.reshape(num_blocks, BLOCK_WORDS)
+        return bloom_filter
+
+
     # =================================================================================================
     # HELPER FUNCTIONS ================================================================================
 
-    def get_digest(self, key: bytes, seed: int) -> int:
-        return (mmh3.hash(key, seed=seed) & 0xFFFFFFFF) % len(self.bit_array)
+    def get_key(self, key: bytes) -> np.uint64:
+        # The key is already a hash, its first 4 bytes are used as they are
+        return np.uint64(int.from_bytes(key[:4], "little") ^ self.seed)
 
 
 
 if __name__ == "__main__":
+    from hashlib import sha256
+
     bloomfilter = BloomFilter(10)
 
     items = [
@@ -56,6 +197,6 @@ if __name__ == "__main__":
     ]
 
     for item in items:
-        bloomfilter.add(item)
+        bloomfilter.add(sha256(item.encode("utf-8")).digest()[:c.PREFIX_SIZE])
 
-    print(bloomfilter.check("google.com"))
\ No newline at end of file
+    print(bloomfilter.check(sha256("google.com".encode("utf-8")).digest()[:c.PREFIX_SIZE]))
\ No newline at end of file
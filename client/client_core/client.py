@@ -1,7 +1,14 @@
 from pathlib import Path
 from hashlib import sha256
-import pickle
+import os
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full, Empty
+from threading import Event
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 
 from datetime import datetime
@@ -13,6 +20,53 @@ from rich.text import Text
 from bloomfilter import BloomFilter
 import constants as c
 
+# =================================================================================================
+# LOG FORMATTING ==================================================================================
+
+# Every highlighted part of a log line is matched by a single pattern, in one pass over the line
+# Tags are matched by name, other highlights by the name of their group
+# The styles are applied to the plain text, so nothing in a log line, e.g. a URL, is ever read as markup
+SESSION_STYLES = {
+    "SESSION": "yellow",
+    "CHECK": "magenta",
+    "REBUILD": "cyan",
+    "POST": "green",
+    "ERROR": "red bold",
+    "seconds": "bold blue",
+    "safe": "green",
+    "malicious": "red bold",
+}
+SESSION_CONTENT_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - (.*)")
+SESSION_STYLE_PATTERN = re.compile(
+    r"\[(?P<tag>SESSION|CHECK|REBUILD|POST|ERROR)\]"
+    r"|(?P<seconds>\d+.\d+ seconds)"
+    r"|(?i:\b(?P<safe>safe)\b)"
+    r"|(?i:\b(?P<malicious>malicious|failed)\b)"
+)
+
+SERVER_STYLES = {
+    "GET": "cyan",
+    "POST": "green",
+    "ERROR": "red bold",
+    "seconds": "bold blue",
+    "green": "green",
+}
+SERVER_CONTENT_PATTERN = re.compile(r"^(\d{2}:\d{2}:\d{2}) - (.*)")
+SERVER_STYLE_PATTERN = re.compile(
+    r"\[(?P<tag>GET|POST|ERROR)\]"
+    r"|(?P<seconds>\d+.\d+ seconds)"
+    r"|(?i:\b(?P<green>successfully|done)\b)"
+)
+
+def style_log_text(text: str, pattern: re.Pattern, styles: dict[str, str]) -> Text:
+    styled_text = Text(text)
+    for match in pattern.finditer(text):
+        style = styles[match.group("tag") if match.lastgroup == "tag" else match.lastgroup]
+        styled_text.stylize(style, match.start(), match.end())
+    return styled_text
+
+# =================================================================================================
+
 
 class Client:
     get_date = lambda: datetime.now().strftime("%Y-%m-%d")
@@ -23,23 +77,42 @@ class Client:
         self.base_url = base_url
         self.console = console
         self.date = Client.get_date()
+
+        # Every request goes through one session, so connections to the server are kept alive and reused
+        # Requests that fail to connect or hit a busy server are retried with a short backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=c.REBUILD_WORKERS, pool_maxsize=c.REBUILD_WORKERS,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(502, 503, 504), raise_on_status=False)
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        atexit.register(self.session.close)
         
         self.log_path = Path(__file__).resolve().parent/"data"/"log"
+        self.log_path.mkdir(parents=True, exist_ok=True)
 
-        sequential_id = 0
-        while Path.exists(self.log_path/f"{name}-{sequential_id:03d}.log"):
-            sequential_id += 1
+        # List the log folder once and continue after the highest sequential ID used by this name
+        sequential_ids = [
+            int(entry.name[len(name)+1:-4]) for entry in os.scandir(self.log_path)
+            if entry.name.startswith(f"{name}-") and entry.name.endswith(".log") and entry.name[len(name)+1:-4].isdigit()
+        ]
+        sequential_id = max(sequential_ids, default=-1) + 1
 
         self.log_path = self.log_path/f"{name}-{sequential_id:03d}.log"
+
+        # Keep the log file open for the whole session instead of reopening it for every line
+        self.log_file = open(self.log_path, "a", encoding="utf-8", buffering=8192)
+        atexit.register(self.log_file.close)
         self.write_to_log(f"[SESSION] Session started for {name}")
 
-        self.filter_filepath = Path(__file__).resolve().parent/"data"/"local_data"/"bloom_filter.pkl"
+        self.filter_filepath = Path(__file__).resolve().parent/"data"/"local_data"/"bloom_filter.bin"
 
-        if self.filter_filepath.exists():
-            with open(self.filter_filepath, "rb") as bf:
-                self.bloom_filter = pickle.load(bf)
+        # A filter saved by an older version of the client cannot be read, it is rebuilt like a missing one
+        try:
+            self.bloom_filter = BloomFilter.from_file(self.filter_filepath)
             self.write_to_log(f"[SESSION] Successfully loaded the local bloom filter into memory")
-        else:
+        except (FileNotFoundError, ValueError):
             self.write_to_log(f"[SESSION] Bloom filter could not be found, requesting server for a rebuild")
             result = self.rebuild_bloomfilter()
             if result == 1:
@@ -68,7 +141,7 @@ class Client:
             start_time = time()
 
             try:
-                response = requests.get(f"{self.base_url}{c.CONTEXT_PATH}/fetch-hashes?client={self.name}&prefix={hash_prefix.hex()}")
+                response = self.session.get(f"{self.base_url}{c.CONTEXT_PATH}/fetch-hashes?client={self.name}&prefix={hash_prefix.hex()}")
                 response.raise_for_status()
             except requests.exceptions.HTTPError as e:
                 self.write_to_log(f"[ERROR] {e}")
@@ -76,8 +149,10 @@ class Client:
 
             status.update("[i]Processing server response...[/i]")
 
-            hashes = response.content
-            if url_hash in hashes:
+            # The server sends the hashes sorted, so the full hash is binary searched
+            hashes = np.frombuffer(response.content, dtype=f"V{c.HASH_SIZE}")
+            index = np.searchsorted(hashes, np.void(url_hash))
+            if index < len(hashes) and hashes[index] == np.void(url_hash):
                 self.write_to_log(f"[CHECK] The URL is confirmed malicious after {time()-start_time:.4f} seconds")
                 return 1
         
@@ -94,14 +169,13 @@ class Client:
         with self.console.status("[i]Submitting malicious URL to server...[/i]", spinner="point") as status:
             start_time = time()
             try:
-                response = requests.post(f"{self.base_url}{c.CONTEXT_PATH}/submit-malicious-url?client={self.name}&url={url_hash.hex()}")
+                response = self.session.post(f"{self.base_url}{c.CONTEXT_PATH}/submit-malicious-url?client={self.name}&url={url_hash.hex()}")
                 response.raise_for_status()
 
                 self.bloom_filter.add(url_hash[:4])
                 status.update("[i]Updating bloom filter[/i]")
                 
-                with open(self.filter_filepath, "wb") as bf:
-                    pickle.dump(self.bloom_filter, bf)
+                self.bloom_filter.to_file(self.filter_filepath)
 
                 self.write_to_log(f"[POST] Successfully blacklisted the URL in {time()-start_time:.4f} seconds")
 
@@ -125,26 +199,49 @@ class Client:
         with self.console.status("[i]Fetching server blacklist metadata...[/i]", spinner="point") as status:
             start_time = time()
             try:
-                response = requests.get(f"{self.base_url}{c.CONTEXT_PATH}/fetch-blacklist-metadata?client={self.name}")
+                response = self.session.get(f"{self.base_url}{c.CONTEXT_PATH}/fetch-blacklist-metadata?client={self.name}")
                 response.raise_for_status()
 
                 entry_count, partitions = response.json()
                 self.bloom_filter = BloomFilter(entry_count)
 
-                partial_request_urls = (
-                    f"{self.base_url}{c.CONTEXT_PATH}/fetch-prefixes/memtable?client={self.name}&partition=",
-                    f"{self.base_url}{c.CONTEXT_PATH}/fetch-prefixes/index?client={self.name}&partition="
-                )
-
-                for i in range(1, partitions+1):
-                    status.update(f"[i]Fetching list of malicious URLs from the server... ({i}/{partitions})[/i]")
-                    for partial_request_url in partial_request_urls:
-                        response = requests.get(partial_request_url+str(i))
-                        response.raise_for_status()
-
-                        prefix_list = response.content
-                        for j in range(0, len(prefix_list), c.PREFIX_SIZE):
-                            self.bloom_filter.add(prefix_list[j:j + c.PREFIX_SIZE])
+                request_urls = [
+                    f"{self.base_url}{c.CONTEXT_PATH}/fetch-prefixes/{source}?client={self.name}&partition={i}"
+                    for i in range(1, partitions+1) for source in ("memtable", "index")
+                ]
+
+                # Download every prefix list at once, the connections are reused through the client's session
+                # The downloads stream their prefixes through a bounded queue, so only a few chunks are held in memory
+                # and the bloom filter is only ever written to by this thread
+                chunks = Queue(maxsize=c.REBUILD_WORKERS*4)
+                cancelled = Event()
+                with ThreadPoolExecutor(max_workers=c.REBUILD_WORKERS) as executor:
+                    futures = [
+                        executor.submit(self.stream_prefixes, request_url, chunks, cancelled)
+                        for request_url in request_urls
+                    ]
+
+                    try:
+                        # Every download ends with None in the queue, whether it succeeded or not
+                        done = 0
+                        while done < len(futures):
+                            chunk = chunks.get()
+                            if chunk is None:
+                                done += 1
+                                status.update(f"[i]Fetching list of malicious URLs from the server... ({done}/{len(futures)})[/i]")
+                            else:
+                                self.bloom_filter.add_many(chunk, c.PREFIX_SIZE)
+
+                        for future in futures:
+                            future.result()
+                    finally:
+                        # If this loop stops early, the downloads would wait forever on a full queue
+                        # Tell them to stop, and empty the queue so none of them is left blocked
+                        cancelled.set()
+                        try:
+                            while True: chunks.get_nowait()
+                        except Empty:
+                            pass
 
             except requests.exceptions.HTTPError as e:
                 self.write_to_log(f"[ERROR] {e}")
@@ -152,8 +249,7 @@ class Client:
                 return 1
 
             self.write_to_log(f"[REBUILD] Now saving the bloom filter into client's local data")
-            with open(self.filter_filepath, "wb") as bf:
-                pickle.dump(self.bloom_filter, bf)
+            self.bloom_filter.to_file(self.filter_filepath)
 
             status.update("[b green]Done![/b green]")
             sleep(1.75)
@@ -162,24 +258,35 @@ class Client:
         return 0
 
 
-    def print_session_logs(self) -> None:
-        tag_colors = [
-            ("SESSION", "yellow"),
-            ("CHECK", "magenta"),
-            ("REBUILD", "cyan"),
-            ("POST", "green"),
-            ("ERROR", "red bold"),
-        ]
+    def stream_prefixes(self, request_url: str, chunks: Queue, cancelled: Event) -> None:
+        try:
+            with self.session.get(request_url, stream=True) as response:
+                response.raise_for_status()
 
-        tag_patterns = [
-            (re.compile(fr"\[{tag}\]"), f"[{color}][{tag}][/{color}]")
-            for tag, color in tag_colors
-        ]
-        content_pattern = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) - (.*)")
-        seconds_pattern = re.compile(r"(\d+.\d+ seconds)")
-        safe_pattern = re.compile(r"\b(safe)\b", flags=re.IGNORECASE)
-        malicious_pattern = re.compile(r"\b(malicious|failed)\b", flags=re.IGNORECASE)
+                # Only whole prefixes are sent, a prefix cut between two chunks is carried over to the next one
+                remainder = b""
+                for chunk in response.iter_content(chunk_size=c.PREFIX_SIZE*8192):
+                    chunk = remainder + chunk
+                    aligned = len(chunk) - len(chunk) % c.PREFIX_SIZE
+                    if not self.put_chunk(chunks, memoryview(chunk)[:aligned], cancelled): return
+                    remainder = chunk[aligned:]
+        finally:
+            self.put_chunk(chunks, None, cancelled)
+
+
+    def put_chunk(self, chunks: Queue, chunk: memoryview | None, cancelled: Event) -> bool:
+        # Wait for room in the queue, but give up once the rebuild is cancelled
+        while not cancelled.is_set():
+            try:
+                chunks.put(chunk, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
 
+
+    def print_session_logs(self) -> None:
+        self.log_file.flush()
         with open(self.log_path, "r", encoding="utf-8") as log:
             for line in log:
                 if not line:
@@ -187,50 +294,25 @@ class Client:
                     continue
                 line = line.strip()
 
-                match = content_pattern.match(line)
+                match = SESSION_CONTENT_PATTERN.match(line)
                 if match: date, rest = match.groups()
                 else: date, rest = "", line
 
-                for pattern, replacement in tag_patterns:
-                    rest = pattern.sub(replacement, rest)
-
-                rest = seconds_pattern.sub(r"[bold blue]\1[/bold blue]", rest)
-                rest = safe_pattern.sub(r"[green]\1[/green]", rest)
-                rest = malicious_pattern.sub(r"[red bold]\1[/red bold]", rest)
-
-                rest = rest.replace("[", "[[").replace("]", "]]")
-                rest = rest.replace("[[", "[")
-                rest = rest.replace("]]", "]")
-
                 final_text = Text()
                 if date:
                     final_text.append(date, style="dim")
                     final_text.append(" - ")
-                final_text.append(Text.from_markup(rest))
+                final_text.append(style_log_text(rest, SESSION_STYLE_PATTERN, SESSION_STYLES))
 
                 self.console.print(final_text, highlight=False)
 
 
     def print_server_logs(self) -> None:
-        tag_colors = [
-            ("GET", "cyan"),
-            ("POST", "green"),
-            ("ERROR", "red bold"),
-        ]
-
-        tag_patterns = [
-            (re.compile(fr"\[{tag}\]"), f"[{color}][{tag}][/{color}]")
-            for tag, color in tag_colors
-        ]
-        content_pattern = re.compile(r"^(\d{2}:\d{2}:\d{2}) - (.*)")
-        seconds_pattern = re.compile(r"(\d+.\d+ seconds)")
-        green_pattern = re.compile(r"\b(successfully|done)\b", flags=re.IGNORECASE)
-
         with self.console.status("[i]Fetching server logs...[/i]", spinner="point") as status:
             try:
-                response = requests.get(f"{self.base_url}{c.CONTEXT_PATH}/get-logs?client={self.name}")
+                response = self.session.get(f"{self.base_url}{c.CONTEXT_PATH}/get-logs?client={self.name}")
                 response.raise_for_status()
-                logs = response.json()
+                logs = response.text.splitlines()
             except Exception as e:
                 self.console.print("[b red]Sorry! Cannot display server logs right now[/b red]", justify="center")
                 return
@@ -241,29 +323,22 @@ class Client:
                 continue
             line = line.strip()
 
-            match = content_pattern.match(line)
+            match = SERVER_CONTENT_PATTERN.match(line)
             if match: time, rest = match.groups()
             else: time, rest = "", line
 
-            for pattern, replacement in tag_patterns:
-                rest = pattern.sub(replacement, rest)
-
-            rest = seconds_pattern.sub(r"[bold blue]\1[/bold blue]", rest)
-            rest = green_pattern.sub(r"[green]\1[/green]", rest)
-
-            rest = rest.replace("[", "[[").replace("]", "]]")
-            rest = rest.replace("[[", "[")
-            rest = rest.replace("]]", "]")
-
             final_text = Text()
             if time:
                 final_text.append(time, style="dim")
                 final_text.append(" - ")
-            final_text.append(Text.from_markup(rest))
+            final_text.append(style_log_text(rest, SERVER_STYLE_PATTERN, SERVER_STYLES))
 
             self.console.print(final_text, highlight=False)
 
 
     def write_to_log(self, message: str, line_break: bool = False) -> None:
-        with open(self.log_path, "a", encoding="utf-8") as log:
-            log.write(f"{"\n" if line_break else ""}{Client.get_date()} {Client.get_time()} - {message}\n")
\ No newline at end of file
+        self.log_file.write(f"{"\n" if line_break else ""}{Client.get_date()} {Client.get_time()} - {message}\n")
+
+        # Buffered lines are written out at session boundaries and on errors
+        if message.startswith(("[SESSION]", "[ERROR]")):
+            self.log_file.flush()
\ No newline at end of file
@@ -1,3 +1,6 @@
 BF_FP_PROBABILITY = 0.10
+BF_HASH_SEED = 0
+HASH_SIZE = 32
 PREFIX_SIZE = 4
+REBUILD_WORKERS = 16
 CONTEXT_PATH = "/gnarlycursion-api"
\ No newline at end of file
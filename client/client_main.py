@@ -162,4 +162,5 @@ if __name__ == "__main__":
  
     except BaseException as e:
         client.write_to_log(f"[SESSION] Session ended: ({type(e).__name__}) {e}", True)
+        client.log_file.close()
         raise
\ No newline at end of file
@@ -2,6 +2,7 @@ HASHES_PER_IDX = 15625
 HASH_SIZE = 32
 PREFIX_SIZE = 4
 PARTITIONS = 4
+FENCE_STRIDE = 128     # Hashes between the in-memory fences of an index file, 4 KiB of a 32-byte hash file
 PARTITION_NUM = lambda byte: byte >> 6  # type (int) -> int
 CONTEXT_PATH = "/gnarlycursion-api"
 
@@ -1,29 +1,29 @@
 from hashlib import sha256
 from csv import reader as csv_reader
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import sys
 import os
 
 from memtable import MemTable
-from constants import PARTITION_NUM, HASHES_PER_IDX
+from constants import PARTITION_NUM, PARTITIONS, HASHES_PER_IDX, HASH_SIZE
 
 
-def build_idx(memtable: MemTable, out_path: str) -> None:
-    # Simple binary file, simply write the hashes in sequence
-    with open(out_path, "wb") as f:
-        for h in memtable: f.write(h)
+DATASET_BATCH_SIZE = 50000     # URLs hashed per worker task when building from the data set
 
 
-def flush_to_idx(memtable: MemTable, partition: int) -> None:
-    out_dir = Path(__file__).resolve().parent/"data"/"db"/f"partition{partition}"
+def build_idx(memtable: MemTable, out_path: str) -> None:
+    # Simple binary file, the memtable's hashes are already in sequence
+    with open(out_path, "wb") as f:
+        f.write(memtable.hashes())
 
-    idx_num = 1
-    out_path = out_dir/f"idx_{idx_num:03d}.bin"
-    while Path(out_path).exists():
-        idx_num += 1
-        out_path = out_dir/f"idx_{idx_num:03d}.bin"
 
+def flush_to_idx(memtable: MemTable, partition: int, idx_num: int) -> Path:
+    # The caller keeps the number of the partition's next index file, so the folder is never scanned here
+    out_path = Path(__file__).resolve().parent/"data"/"db"/f"partition{partition}"/f"idx_{idx_num:03d}.bin"
     build_idx(memtable, out_path)
+    return out_path
 
 # ============================================================================================================
 # NOTE: This script from here and below is not part of the app itself, but a script used to set up the data
@@ -32,55 +32,55 @@ def flush_to_idx(memtable: MemTable, partition: int) -> None:
 # sort them lexicographically, then write them into binary files, each containing 15,625 hashes.
 
 
-def build_memtables_from_dataset(root_path: str) -> list[list[MemTable]]:
+def build_partitions_from_dataset(root_path: str) -> list[np.ndarray]:
     # Resolve the path to the data set
     dataset_path = root_path/"data"/"malicious_urls.csv"
 
-    # Initialize partitions
-    partitions = [[MemTable() for _ in range(4)]]
-    # Keeps track of which is the current table for a partition
-    index = [0,0,0,0]
-
     # Open the csv file and create a reader object
     with open(dataset_path, "r", newline="", encoding="utf-8") as f:
         reader = csv_reader(f)
         # Skip the header row
         next(reader)
 
-        for row in reader:
-            digest = sha256(row[0].encode("utf-8")).digest()
-            # Divide the first byte of the hash by 64 to determine which partition it belongs to
-            partition = PARTITION_NUM(digest[0])
+        urls = [row[0] for row in reader]
 
-            # Insert the hash
-            partitions[index[partition]][partition].insert(digest)
+    # Every URL is hashed independently, so batches of them are hashed on every core
+    # Each batch comes back as one buffer of back-to-back hashes, in the order of its URLs
+    batches = [urls[i:i+DATASET_BATCH_SIZE] for i in range(0, len(urls), DATASET_BATCH_SIZE)]
+    with ProcessPoolExecutor() as executor:
+        digests = b"".join(executor.map(hash_urls, batches))
+    hashes = np.frombuffer(digests, dtype=f"V{HASH_SIZE}")
 
-            # Check if the table has reached the limit
-            if len(partitions[index[partition]][partition]) >= HASHES_PER_IDX:
-                # If needed, add another list of memtables if a partition's table has reached their limit
-                if len(partitions)-1 <= index[partition]:
-                    partitions.append([MemTable() for _ in range(4)])
+    # Divide the first byte of each hash by 64 to determine which partition it belongs to
+    partitions = PARTITION_NUM(np.frombuffer(digests, dtype=np.uint8)[::HASH_SIZE])
 
-                index[partition] += 1   # Update the index so that it points to the correct memtable
+    # Sort each partition once and drop duplicate hashes
+    return [np.unique(hashes[partitions == partition]) for partition in range(PARTITIONS)]
 
-    return partitions
 
+def hash_urls(urls: list[str]) -> bytes:
+    return b"".join(sha256(url.encode("utf-8")).digest() for url in urls)
 
 if __name__ == "__main__":
     sys.path.append(str(Path(__file__).resolve().parent.parent))
 
     ROOT_PATH = Path(__file__).resolve().parent.parent.parent
-    memtables = build_memtables_from_dataset(ROOT_PATH)
+    partitions = build_partitions_from_dataset(ROOT_PATH)
 
     for folder_name in [ROOT_PATH/"server"/"server_core"/"data"/"db"/f"partition{i}" for i in range(1, 5)]:
         os.makedirs(folder_name, exist_ok=True)
-
-    # Save the memtables into binary files
-    for i in range(len(memtables)):
-        for j in range(4):
-            # If the memtable has the expected size, write it into a binary file
-            if len(memtables[i][j]) >= HASHES_PER_IDX:
-                build_idx(memtables[i][j], ROOT_PATH/"server"/"server_core"/"data"/"db"/f"partition{j+1}"/f"idx_{i+1:03d}.bin")
-            # If memtable is still small, write it into a binary file as a Write-ahead Log
-            elif len(memtables[i][j]) > 0:
-                build_idx(memtables[i][j], ROOT_PATH/"server"/"server_core"/"data"/"log"/"write_ahead"/f"partition{j+1}.bin")
\ No newline at end of file
+        # The prefix file belongs to the old index files, the server writes a new one on startup
+        (folder_name/"prefixes.bin").unlink(missing_ok=True)
+
+    # Save every partition into binary files
+    for j, hashes in enumerate(partitions):
+        # Split the sorted hashes into index files of the expected size
+        full_files = len(hashes) // HASHES_PER_IDX
+        for i in range(full_files):
+            with open(ROOT_PATH/"server"/"server_core"/"data"/"db"/f"partition{j+1}"/f"idx_{i+1:03d}.bin", "wb") as f:
+                f.write(hashes[i*HASHES_PER_IDX : (i+1)*HASHES_PER_IDX].tobytes())
+
+        # The rest of the hashes are written into a binary file as a Write-ahead Log
+        if len(hashes) > full_files*HASHES_PER_IDX:
+            with open(ROOT_PATH/"server"/"server_core"/"data"/"log"/"write_ahead"/f"partition{j+1}.bin", "wb") as f:
+                f.write(hashes[full_files*HASHES_PER_IDX:].tobytes())
\ No newline at end of file
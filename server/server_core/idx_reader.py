@@ -1,5 +1,7 @@
 from pathlib import Path
+import numpy as np
 import mmap
+import os
 
 import constants as c
 from memtable import MemTable
@@ -14,9 +16,15 @@ def build_memtable_from_WAL(partition_num: int) -> MemTable:
         return memtable
     
     with open(wal_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
-        for offset in range(0, len(mm), c.HASH_SIZE):
+        # A crash in the middle of a write can leave part of a hash at the end of the log, only read whole hashes
+        whole_size = len(mm) - len(mm) % c.HASH_SIZE
+        for offset in range(0, whole_size, c.HASH_SIZE):
             memtable.insert(mm[offset:offset + c.HASH_SIZE])
 
+    # Cut the partial hash off, so the next hash appended to the log starts at a hash boundary
+    if whole_size != wal_path.stat().st_size:
+        os.truncate(wal_path, whole_size)
+
     return memtable
 
 
@@ -24,95 +32,131 @@ class IndexReader:
     def __init__(self, partition_number: int):
         self.dir_path = Path(__file__).resolve().parent/"data"/"db"/f"partition{partition_number}"
 
+        self.dir_path.mkdir(parents=True, exist_ok=True)
+
+        # List the index files once, new ones are registered through add_idx_file
+        self.idx_files = sorted(
+            entry.path for entry in os.scandir(self.dir_path)
+            if entry.name.startswith("idx_") and entry.name.endswith(".bin")
+        )
+        # Number new index files after the highest existing one, a gap in the numbering is never written over
+        self.next_idx_num = max((int(Path(file_path).stem[4:]) for file_path in self.idx_files), default=0) + 1
+
+        # Map every index file once, lookups only page in the parts of a file they touch
+        self.idx_maps = {}
+        self.idx_hashes = {}
+        self.idx_bounds = {}
+        self.idx_fences = {}
+        for file_path in self.idx_files:
+            self.map_idx_file(file_path)
+
+        # The prefixes of every index file are kept in one file, so they can be sent straight from disk
+        # Always rewrite it on startup, the index files may have been rebuilt by the data set script since
+        self.prefix_path = self.dir_path/"prefixes.bin"
+        self.write_prefix_file()
+
     
     def range_lookup(self, lower_bound: bytes, upper_bound: bytes) -> bytearray:
         results = bytearray()
-        hashes_per_idx = c.HASHES_PER_IDX
         hash_size = c.HASH_SIZE
+        lower_key, upper_key = np.void(lower_bound), np.void(upper_bound)
 
-        idx_num = 1
-        file_path = self.dir_path/f"idx_{idx_num:03d}.bin"
-
-        while Path(file_path).is_file():
-            with open(file_path, "rb") as f:
-                data = f.read()
-
-            low, high = 0, hashes_per_idx - 1
-            while low < high:
-                mid = (low + high) >> 1
-                start = mid * hash_size
-                url_hash = data[start:start+hash_size]
-
-                if lower_bound > url_hash: low = mid + 1
-                else: high = mid
-
-            lower_index = low
+        for file_path in self.idx_files:
+            # Skip the files whose range of hashes is disjoint from the bounds
+            first_hash, last_hash = self.idx_bounds[file_path]
+            if last_hash < lower_bound or first_hash > upper_bound: continue
 
-            low, high = 0, hashes_per_idx - 1
-            while low < high:
-                mid = (low + high) >> 1
-                start = mid * hash_size
-                url_hash = data[start:start + hash_size]
+            # First hash at or above the lower bound, and first hash above the upper bound
+            lower_index = self.search_idx_file(file_path, lower_key, "left")
+            upper_index = self.search_idx_file(file_path, upper_key, "right")
 
-                if upper_bound >= url_hash: low = mid + 1
-                else: high = mid
-
-            upper_index = low
-
-            results.extend(data[lower_index*hash_size : upper_index*hash_size])
-            idx_num += 1
-            file_path = self.dir_path/f"idx_{idx_num:03d}.bin"
+            # Slice a view of the map, the hashes are copied once, straight from the page cache into the results
+            with memoryview(self.idx_maps[file_path]) as data:
+                results += data[lower_index*hash_size : upper_index*hash_size]
         
         return results
     
 
     def contains_hash(self, key: bytes) -> bool:
-        hashes_per_idx = c.HASHES_PER_IDX
-        hash_size = c.HASH_SIZE
+        void_key = np.void(key)
 
-        idx_num = 1
-        file_path = self.dir_path/f"idx_{idx_num:03d}.bin"
+        for file_path in self.idx_files:
+            first_hash, last_hash = self.idx_bounds[file_path]
+            if not first_hash <= key <= last_hash: continue
 
-        while Path(file_path).is_file():
-            with open(file_path, "rb") as f:
-                data = f.read()
+            hashes = self.idx_hashes[file_path]
 
-            low, high = 0, hashes_per_idx - 1
-            while low <= high:
-                mid = (low+high) >> 1
-                start = mid*hash_size
-                url_hash = data[start:start+hash_size]
-
-                if key == url_hash: return True
-                elif key < url_hash: high = mid-1
-                else: low = mid+1
-
-            idx_num += 1
-            file_path = self.dir_path/f"idx_{idx_num:03d}.bin"
+            index = self.search_idx_file(file_path, void_key, "left")
+            if index < len(hashes) and hashes[index] == void_key: return True
 
         return False
     
 
     def get_all_hash_prefixes(self) -> bytearray:
-        byte_records = bytearray()
-        idx_num = 1
-        file_path = self.dir_path/f"idx_{idx_num:03d}.bin"
+        prefix_size = c.PREFIX_SIZE
+
+        # Preallocate the prefixes of every file, and copy each file's prefix column straight into its rows
+        total = sum(len(self.idx_hashes[file_path]) for file_path in self.idx_files)
+        byte_records = bytearray(total * prefix_size)
+        prefixes = np.frombuffer(byte_records, dtype=np.uint8).reshape(-1, prefix_size)
 
-        while Path(file_path).is_file():
-            with open(file_path, "rb") as f:
-                while sha256_hash := f.read(c.HASH_SIZE):
-                    byte_records.extend(sha256_hash[:4])
-            idx_num += 1
-            file_path = self.dir_path/f"idx_{idx_num:03d}.bin"
+        offset = 0
+        for file_path in self.idx_files:
+            hashes = np.frombuffer(self.idx_maps[file_path], dtype=np.uint8).reshape(-1, c.HASH_SIZE)
+            prefixes[offset:offset+len(hashes)] = hashes[:, :prefix_size]
+            offset += len(hashes)
 
         return byte_records
     
 
     def get_idx_file_amount(self) -> int:
-        idx_num = 1
-        file_path = self.dir_path/f"idx_{idx_num:03d}.bin"
-        while Path(file_path).is_file():
-            idx_num += 1
-            file_path = self.dir_path/f"idx_{idx_num:03d}.bin"
+        return len(self.idx_files)
+    
+
+    def add_idx_file(self, file_path: Path) -> None:
+        self.idx_files.append(str(file_path))
+        self.next_idx_num += 1
+        self.map_idx_file(str(file_path))
+
+        # Only append the new file's prefixes, the bytes already in the file never change under a response
+        hashes = np.frombuffer(self.idx_maps[str(file_path)], dtype=np.uint8).reshape(-1, c.HASH_SIZE)
+        with open(self.prefix_path, "ab") as f:
+            f.write(hashes[:, :c.PREFIX_SIZE].tobytes())
+
+    # =================================================================================================
+    # HELPER FUNCTIONS ================================================================================
+
+    def write_prefix_file(self) -> None:
+        # Swap in a complete file, a crash while writing never leaves half of one behind
+        temp_path = self.prefix_path.with_suffix(".tmp")
+        with open(temp_path, "wb") as f:
+            f.write(self.get_all_hash_prefixes())
+        os.replace(temp_path, self.prefix_path)
+
+
+    def map_idx_file(self, file_path: str) -> None:
+        # The map stays valid after the file is closed, slicing it returns bytes
+        with open(file_path, "rb") as f:
+            self.idx_maps[file_path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # View the map as an array of whole hashes, searched in C by np.searchsorted
+        self.idx_hashes[file_path] = np.frombuffer(self.idx_maps[file_path], dtype=f"V{c.HASH_SIZE}")
+
+        # Keep the first and last hash of the file, lookups outside of them skip the file entirely
+        data = self.idx_maps[file_path]
+        self.idx_bounds[file_path] = (data[:c.HASH_SIZE], data[-c.HASH_SIZE:])
+
+        # Copy every FENCE_STRIDE-th hash into memory, one per page of the file
+        # A search goes through these fences first, and then only reads a single page of the map
+        self.idx_fences[file_path] = self.idx_hashes[file_path][::c.FENCE_STRIDE].copy()
+
+
+    def search_idx_file(self, file_path: str, key: np.void, side: str) -> int:
+        # Same result as np.searchsorted over the whole file
+        # The fences before the key place the answer within one stride of hashes
+        hashes = self.idx_hashes[file_path]
+        fence = np.searchsorted(self.idx_fences[file_path], key, side=side)
 
-        return idx_num - 1
\ No newline at end of file
+        start = max(fence-1, 0) * c.FENCE_STRIDE
+        end = min(fence*c.FENCE_STRIDE + 1, len(hashes))
+        return start + int(np.searchsorted(hashes[start:end], key, side=side))
\ No newline at end of file
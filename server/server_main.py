@@ -1,40 +1,82 @@
 from pathlib import Path
 import sys
+import os
 sys.path.append(str(Path(__file__).resolve().parent/"server_core"))
 
 from fastapi import FastAPI, Request, Response, status
+from fastapi.responses import StreamingResponse
 from contextlib import asynccontextmanager
 import asyncio
+import aiofiles
 import uvicorn
+import numpy as np
 
-from datetime import datetime
-from time import time
+from datetime import datetime, timedelta
+from time import time, strftime
 import argparse
 
 from idx_reader import IndexReader, build_memtable_from_WAL
 from idx_builder import flush_to_idx
 import constants as c
 
+# The smallest and largest hash suffixes, padding a prefix into the bounds of its range of hashes
+PAD_LO = b"\x00"*(c.HASH_SIZE-c.PREFIX_SIZE)
+PAD_HI = b"\xFF"*(c.HASH_SIZE-c.PREFIX_SIZE)
+
 # =================================================================================================
 # HELPER FUNCTIONS ================================================================================
 
-get_date = lambda: datetime.now().strftime("%Y-%m-%d")
-get_time = lambda: datetime.now().strftime("%H:%M:%S")
+get_date = lambda: strftime("%Y-%m-%d")
+get_time = lambda: strftime("%H:%M:%S")
 
-def generate_activity_log(date: str) -> Path:
+def generate_activity_log(date: str, message: str = "Server started") -> Path:
     time = get_time()
 
     file_path = Path(__file__).parent/"server_core"/"data"/"log"/"activity"/f"{date}.log"
+    file_path.parent.mkdir(parents=True, exist_ok=True)
     line_break = file_path.exists()
 
     with open(file_path, "a", encoding="utf-8") as log:
-        log.write(f"{"\n" if line_break else ""}{time} - [SESSION] Server started\n")
+        log.write(f"{"\n" if line_break else ""}{time} - [SESSION] {message}\n")
     return file_path
 
 
-def write_to_log(request: Request, client_name: str, message: str, line_break: bool = False) -> None:
-    with open(request.app.state.log_path, "a", encoding="utf-8") as log:
-        log.write(f"{"\n" if line_break else ""}{get_time()} - [CLIENT: {client_name}] {message}\n")
+def seconds_until_midnight() -> float:
+    now = datetime.now()
+    midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return (midnight - now).total_seconds()
+
+
+async def rotate_activity_log(server: FastAPI) -> None:
+    # Switch to the next day's log file at midnight, so requests never have to check the date themselves
+    while True:
+        await asyncio.sleep(seconds_until_midnight() + 1)
+        async with server.state.log_lock:
+            server.state.date = get_date()
+            server.state.log_path = generate_activity_log(server.state.date, "Server running since a previous day")
+
+
+async def write_to_log(request: Request, client_name: str, message: str, line_break: bool = False) -> None:
+    # The file is written in a worker thread, so a slow disk never stalls the other requests
+    async with aiofiles.open(request.app.state.log_path, "a", encoding="utf-8") as log:
+        await log.write(f"{"\n" if line_break else ""}{get_time()} - [CLIENT: {client_name}] {message}\n")
+
+
+async def stream_open_file(file, size: int, chunk_size: int = 64*1024):
+    # Send the first 'size' bytes of an already open file, anything appended after it was opened is left out
+    try:
+        while size > 0 and (chunk := await file.read(min(chunk_size, size))):
+            size -= len(chunk)
+            yield chunk
+    finally:
+        await file.close()
+
+
+async def stream_activity_log(log_path: Path, chunk_size: int = 64*1024):
+    # Send the log a chunk at a time, it is never read into memory as a whole
+    async with aiofiles.open(log_path, "rb") as log:
+        while chunk := await log.read(chunk_size):
+            yield chunk
 
 # =================================================================================================
 # SERVER CONTEXT ==================================================================================
@@ -45,25 +87,36 @@ async def lifespan(server: FastAPI):
     server.state.idx_readers = [IndexReader(i) for i in range(1, c.PARTITIONS+1)]
     # Load write-ahead logs into memory with Memtables
     server.state.memtables = [build_memtable_from_WAL(i) for i in range(1, c.PARTITIONS+1)]
+    # Keep every write-ahead log open for appending, unbuffered so each hash reaches the file right away
+    server.state.wal_files = [
+        open(Path(__file__).resolve().parent/"server_core"/"data"/"log"/"write_ahead"/f"partition{i}.bin", "ab", buffering=0)
+        for i in range(1, c.PARTITIONS+1)
+    ]
+    # Keep the amount of hashes in every partition, so the metadata endpoint never has to count them
+    server.state.counts = [
+        len(memtable) + reader.get_idx_file_amount()*c.HASHES_PER_IDX
+        for memtable, reader in zip(server.state.memtables, server.state.idx_readers)
+    ]
     # Create a log file or use an existing one
     server.state.date = get_date()
     server.state.log_path = generate_activity_log(server.state.date)
     # Create locks to prevent race conditions
     server.state.log_lock = asyncio.Lock()
-    server.state.idx_lock = asyncio.Lock()
-    server.state.memtable_lock = asyncio.Lock()
+    # Every partition has its own locks, requests for different partitions never wait on each other
+    server.state.idx_locks = [asyncio.Lock() for _ in range(c.PARTITIONS)]
+    server.state.memtable_locks = [asyncio.Lock() for _ in range(c.PARTITIONS)]
+    # Rotate the log file in the background
+    rotation = asyncio.create_task(rotate_activity_log(server))
 
     yield   # Let the server run
 
-    # Write to log
-    if get_date() != server.state.date:
-        server.state.date = get_date()
-        server.state.log_path = Path(__file__).parent/"server_core"/"data"/"log"/"activity"/f"{server.state.date}.log"
-        line_break = False
-    else: line_break = True
+    rotation.cancel()
+    for wal_file in server.state.wal_files:
+        wal_file.close()
 
+    # Write to log
     with open(server.state.log_path, "a", encoding="utf-8") as log:
-        log.write(f"{"\n" if line_break else ""}{get_time()} - [SESSION] Server shutting down")
+        log.write(f"\n{get_time()} - [SESSION] Server shutting down")
 
 
 server = FastAPI(lifespan=lifespan, root_path=c.CONTEXT_PATH)
@@ -76,139 +129,140 @@ async def fetch_hashes(client: str, prefix: str, request: Request):
     bytes_prefix = bytes.fromhex(prefix)
     
     async with request.app.state.log_lock:
-        if get_date() != request.app.state.date:
-            request.app.state.date = get_date()
-            request.app.state.log_path = generate_activity_log()
-        write_to_log(request, client, f"[GET] Retrieving full hashes for hash prefix {prefix}", True)
+        await write_to_log(request, client, f"[GET] Retrieving full hashes for hash prefix {prefix}", True)
 
     start_time = time()
 
-    lower_bound = bytes_prefix + b"\x00"*(c.HASH_SIZE-c.PREFIX_SIZE)
-    upper_bound = bytes_prefix + b"\xFF"*(c.HASH_SIZE-c.PREFIX_SIZE)
+    lower_bound = bytes_prefix + PAD_LO
+    upper_bound = bytes_prefix + PAD_HI
 
     partition = c.PARTITION_NUM(bytes_prefix[0])
 
-    async with request.app.state.memtable_lock:
+    async with request.app.state.memtable_locks[partition]:
         hashes = request.app.state.memtables[partition].range_lookup(lower_bound, upper_bound)
-    async with request.app.state.idx_lock:
+    async with request.app.state.idx_locks[partition]:
         hashes.extend(request.app.state.idx_readers[partition].range_lookup(lower_bound, upper_bound))
 
+    # Each source returns its own sorted run, sort them together so the client can binary search the response
+    hashes = np.sort(np.frombuffer(hashes, dtype=f"V{c.HASH_SIZE}")).tobytes()
+
     time_taken = time() - start_time
     async with request.app.state.log_lock:
-        write_to_log(request, client, f"[GET] Successfully fetched hashes with prefix {bytes_prefix} in {time_taken:.4f} seconds")
+        await write_to_log(request, client, f"[GET] Successfully fetched hashes with prefix {bytes_prefix} in {time_taken:.4f} seconds")
 
-    return Response(content=bytes(hashes), media_type="application/octet-stream")
+    return Response(content=hashes, media_type="application/octet-stream")
 
 
 @server.post("/submit-malicious-url")
 async def submit_malicious_url(client: str, url: str, request: Request):
     async with request.app.state.log_lock:
-        if get_date() != request.app.state.date:
-            request.app.state.date = get_date()
-            request.app.state.log_path = generate_activity_log()
-        write_to_log(request, client, "[POST] Blacklisting a URL hash", True)
+        await write_to_log(request, client, "[POST] Blacklisting a URL hash", True)
+
+    # Only whole SHA-256 hashes in hex are accepted, anything else would not fit the memtable or the index files
+    try:
+        url_hash = bytes.fromhex(url)
+    except ValueError:
+        url_hash = b""
+    if len(url_hash) != c.HASH_SIZE:
+        async with request.app.state.log_lock:
+            await write_to_log(request, client, "[ERROR] URL hash is not a valid SHA-256 hash")
+        return Response(content="Bad request: URL hash must be a SHA-256 hash in hex", status_code=status.HTTP_400_BAD_REQUEST)
 
-    url_hash = bytes.fromhex(url)
     partition = c.PARTITION_NUM(url_hash[0])
 
     async with request.app.state.log_lock:
-        write_to_log(request, client, "[POST] Checking if URL already exists")
+        await write_to_log(request, client, "[POST] Checking if URL already exists")
         
-    async with request.app.state.idx_lock:
+    async with request.app.state.idx_locks[partition]:
         if request.app.state.idx_readers[partition].contains_hash(url_hash):
             async with request.app.state.log_lock:
-                write_to_log(request, client, "[POST] URL already exists in the blacklist")
+                await write_to_log(request, client, "[POST] URL already exists in the blacklist")
             return Response(content="Bad request: URL is already blacklisted", status_code=status.HTTP_400_BAD_REQUEST)
 
-    async with request.app.state.memtable_lock:
+    async with request.app.state.memtable_locks[partition]:
         memtable = request.app.state.memtables[partition]
 
         if url_hash in memtable:
             async with request.app.state.log_lock:
-                write_to_log(request, client, "[ERROR] URL already exists")
+                await write_to_log(request, client, "[ERROR] URL already exists")
             return Response(content="Bad request: URL is already blacklisted", status_code=status.HTTP_400_BAD_REQUEST)
         
         memtable.insert(url_hash)
-        wal_path = Path(__file__).resolve().parent/"server_core"/"data"/"log"/"write_ahead"/f"partition{partition}.bin"
+        # A flush moves the hashes from the memtable into an index file, so only an insert changes the count
+        request.app.state.counts[partition] += 1
+        wal_file = request.app.state.wal_files[partition]
 
         if len(memtable) >= c.HASHES_PER_IDX:
             async with request.app.state.log_lock:
-                write_to_log(request, client, f"[POST] Flushing partition {partition} memtable to new index file")
+                await write_to_log(request, client, f"[POST] Flushing partition {partition} memtable to new index file")
 
             start_time = time()
 
-            async with request.app.state.idx_lock:
-                flush_to_idx(memtable, partition)
-            with open(wal_path, "w") as f:
-                pass
+            async with request.app.state.idx_locks[partition]:
+                idx_reader = request.app.state.idx_readers[partition]
+                idx_reader.add_idx_file(flush_to_idx(memtable, partition+1, idx_reader.next_idx_num))
+            memtable.clear()
+            wal_file.truncate(0)
+            wal_file.seek(0)
 
             async with request.app.state.log_lock:
-                write_to_log(request, client, f"[POST] Flushed the partition {partition} memtable in {time()-start_time:.4f} seconds")
+                await write_to_log(request, client, f"[POST] Flushed the partition {partition} memtable in {time()-start_time:.4f} seconds")
         else:
             async with request.app.state.log_lock:
-                write_to_log(request, client, "[POST] Writing the hash into the write-ahead log")
-            with open(wal_path, "ab") as f:
-                f.write(url_hash)
+                await write_to_log(request, client, "[POST] Writing the hash into the write-ahead log")
+            await asyncio.get_running_loop().run_in_executor(None, wal_file.write, url_hash)
 
     async with request.app.state.log_lock:
-        write_to_log(request, client, f"[POST] URL successfully blacklisted")
+        await write_to_log(request, client, f"[POST] URL successfully blacklisted")
 
 
 @server.get("/fetch-prefixes/memtable")
 async def get_memtable_hash_prefixes(client: str, partition: int, request: Request):
     async with request.app.state.log_lock:
-        if get_date() != request.app.state.date:
-            request.app.state.date = get_date()
-            request.app.state.log_path = generate_activity_log()
-        write_to_log(request, client, f"[GET] Fetching all hash prefixes in the partition {partition} memtable")
+        await write_to_log(request, client, f"[GET] Fetching all hash prefixes in the partition {partition} memtable")
 
     start_time = time()
-    async with request.app.state.memtable_lock:
-        hash_prefixes = bytearray()
-        for url_hash in request.app.state.memtables[partition-1]:
-            hash_prefixes.extend(url_hash[:4])
+    async with request.app.state.memtable_locks[partition-1]:
+        hash_prefixes = request.app.state.memtables[partition-1].prefixes()
 
     async with request.app.state.log_lock:
-        write_to_log(request, client, f"[GET] Successfully fetched all hash prefixes in the partition {partition} memtable in {time()-start_time:.4f} seconds")
+        await write_to_log(request, client, f"[GET] Successfully fetched all hash prefixes in the partition {partition} memtable in {time()-start_time:.4f} seconds")
 
-    return Response(content=bytes(hash_prefixes), media_type="application/octet-stream")
+    return Response(content=hash_prefixes, media_type="application/octet-stream")
 
 
 @server.get("/fetch-prefixes/index")
 async def get_idx_hash_prefixes(client: str, partition: int, request: Request):
     async with request.app.state.log_lock:
-        if get_date() != request.app.state.date:
-            request.app.state.date = get_date()
-            request.app.state.log_path = generate_activity_log()
-        write_to_log(request, client, f"[GET] Fetching all hash prefixes in the partition {partition} index files")
+        await write_to_log(request, client, f"[GET] Fetching all hash prefixes in the partition {partition} index files")
 
     start_time = time()
-    async with request.app.state.idx_lock:
-        hash_prefixes = request.app.state.idx_readers[partition-1].get_all_hash_prefixes()
+    # Open the file and take its size while no flush can append to it
+    async with request.app.state.idx_locks[partition-1]:
+        prefix_file = await aiofiles.open(request.app.state.idx_readers[partition-1].prefix_path, "rb")
+        prefix_size = os.fstat(prefix_file.fileno()).st_size
 
     async with request.app.state.log_lock:
-        write_to_log(request, client, f"[GET] Successfully fetched all hash prefixes in the partition {partition} index files in {time()-start_time:.4f} seconds")
+        await write_to_log(request, client, f"[GET] Successfully fetched all hash prefixes in the partition {partition} index files in {time()-start_time:.4f} seconds")
 
-    return Response(content=bytes(hash_prefixes), media_type="application/octet-stream")
+    # The prefixes are kept in a file next to the index files, send it as it was on disk when it was opened
+    return StreamingResponse(
+        stream_open_file(prefix_file, prefix_size),
+        headers={"Content-Length": str(prefix_size)}, media_type="application/octet-stream"
+    )
 
 
 @server.get("/fetch-blacklist-metadata")
 async def get_blacklist_size(client: str, request: Request):
     async with request.app.state.log_lock:
-        if get_date() != request.app.state.date:
-            request.app.state.date = get_date()
-            request.app.state.log_path = generate_activity_log()
-        write_to_log(request, client, "[GET] Fetching blacklist metadata", True)
+        await write_to_log(request, client, "[GET] Fetching blacklist metadata", True)
 
     start_time = time()
-    size = sum(reader.get_idx_file_amount()*c.HASHES_PER_IDX for reader in request.app.state.idx_readers)
-
-    async with request.app.state.memtable_lock:
-        for memtable in request.app.state.memtables:
-            size += len(memtable)
+    # The counts are only changed between awaits, so they can be summed without a lock
+    size = sum(request.app.state.counts)
 
     async with request.app.state.log_lock:
-        write_to_log(request, client, f"[GET] Done fetching metadata in {time()-start_time:.4f} seconds")
+        await write_to_log(request, client, f"[GET] Done fetching metadata in {time()-start_time:.4f} seconds")
 
     return [size, c.PARTITIONS]
 
@@ -216,13 +270,11 @@ async def get_blacklist_size(client: str, request: Request):
 @server.get("/get-logs")
 async def get_logs(client: str, request: Request):
     async with request.app.state.log_lock:
-        if get_date() != request.app.state.date:
-            request.app.state.date = get_date()
-            request.app.state.log_path = generate_activity_log()
-        write_to_log(request, client, "[GET] Fetching server logs", True)
+        await write_to_log(request, client, "[GET] Fetching server logs", True)
+        log_path = request.app.state.log_path
 
-        with open(request.app.state.log_path, "r", encoding="utf-8") as f:
-            return f.readlines()
+    # The log is only ever appended to, so it is streamed without holding the lock over the other requests
+    return StreamingResponse(stream_activity_log(log_path), media_type="text/plain; charset=utf-8")
 
 # =================================================================================================
 # RUN THE SERVER ==================================================================================